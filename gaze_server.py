@@ -3,18 +3,27 @@ Sharingan Eye Tracking Server - IMPROVED ACCURACY VERSION
 Uses OpenCV Haar Cascades with advanced calibration for precise tracking
 """
 
+import os
 import cv2
 import numpy as np
 import asyncio
 import websockets
-import json
+import orjson
 import time
-import base64
+import struct
+import concurrent.futures
+import threading
 from collections import deque
 
+try:
+    import uvloop  # faster event loop; not available on Windows
+except ImportError:
+    uvloop = None
+
 # ============== CONFIGURATION ==============
 CONFIG = {
     "WEBSOCKET_PORT": 8765,
+    "PREVIEW_PORT": 8766,  # separate socket for the camera preview
     "CAMERA_ID": 0,
     "CAMERA_WIDTH": 640,
     "CAMERA_HEIGHT": 480,
@@ -44,9 +53,72 @@ CONFIG = {
     # Head movement compensation
     "HEAD_COMPENSATION_X": 0.3,
     "HEAD_COMPENSATION_Y": 0.3,
+    
+    # Run cascade detection through OpenCL (T-API) when a GPU is available
+    "USE_OPENCL": True,
+    
+    # Between full-frame face scans only a window around the last face is searched
+    "FACE_RESCAN_INTERVAL": 30,  # frames
+    
+    # Skip the face/eye cascades while the image is static (mean abs difference
+    # of an 80x60 thumbnail, in gray levels), re-detecting at least every N frames
+    "MOTION_SKIP_THRESHOLD": 2.0,
+    "MOTION_SKIP_MAX_FRAMES": 4,
+    
+    # Gaze samples are sent in batches: whichever limit is reached first
+    "GAZE_BATCH_SIZE": 3,
+    "GAZE_BATCH_INTERVAL_MS": 50,
+    # Send gaze batches as compact binary records instead of JSON (see README)
+    "BINARY_GAZE": False,
 }
 
 
+# Binary websocket messages start with a one-byte type (text frames carry JSON)
+MSG_PREVIEW_JPEG = b'\x01'
+MSG_GAZE_BATCH = b'\x02'
+
+# One binary gaze sample: x, y, confidence (float32), timestamp in ms (int64), little-endian
+GAZE_SAMPLE = struct.Struct('<fffq')
+
+
+def dumps(message):
+    """Serialize an outgoing message with orjson, as str so it goes out as a text frame"""
+    return orjson.dumps(message, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+
+
+def encode_gaze_batch(samples):
+    """Build a gaze batch message (JSON, or binary with BINARY_GAZE) from (x, y, confidence, timestamp_ms) tuples"""
+    if CONFIG["BINARY_GAZE"]:
+        return MSG_GAZE_BATCH + b''.join([GAZE_SAMPLE.pack(*sample) for sample in samples])
+    
+    return dumps({
+        "type": "gaze_batch",
+        "items": [
+            {"x": round(x, 1), "y": round(y, 1), "confidence": round(c, 2), "timestamp": t}
+            for x, y, c, t in samples
+        ]
+    })
+
+
+class LatestQueue:
+    """Single-consumer queue between pipeline stages that drops the oldest item when full (event-loop thread only)"""
+    
+    def __init__(self, maxsize):
+        self._items = deque(maxlen=maxsize)
+        self._waiter = None
+    
+    def put(self, item):
+        self._items.append(item)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+    
+    async def get(self):
+        while not self._items:
+            self._waiter = asyncio.get_running_loop().create_future()
+            await self._waiter
+        return self._items.popleft()
+
+
 class ImprovedGazeEstimator:
     def __init__(self):
         # Load cascades
@@ -54,22 +126,35 @@ class ImprovedGazeEstimator:
         self.face_cascade = cv2.CascadeClassifier(cv_path + 'haarcascade_frontalface_default.xml')
         self.eye_cascade = cv2.CascadeClassifier(cv_path + 'haarcascade_eye.xml')
         
-        # Smoothing
-        self.gaze_history_x = deque(maxlen=CONFIG["SMOOTHING_BUFFER_SIZE"])
-        self.gaze_history_y = deque(maxlen=CONFIG["SMOOTHING_BUFFER_SIZE"])
+        # Smoothing: ring buffer of recent samples plus running sums, so the
+        # linearly weighted average (oldest = 1 ... newest = n) is updated in O(1)
+        buf = CONFIG["SMOOTHING_BUFFER_SIZE"]
+        self._ring_x = [0.0] * buf
+        self._ring_y = [0.0] * buf
+        self._ring_i = 0
+        self._ring_n = 0
+        self._sum_x = self._sum_y = 0.0    # plain sum of buffered samples
+        self._wsum_x = self._wsum_y = 0.0  # weighted sum of buffered samples
         self.ema_x = None
         self.ema_y = None
         
         # Tracking state
         self.last_face = None
         self.last_eyes = []
+        self.frames_since_scan = 0
+        self.roi_misses = 0
+        self.static_frames = 0
+        self._prev_thumb = None  # thumbnail of the last frame the cascades ran on
         self.baseline_iris = None
         self.baseline_head = None
         
         # Calibration - using homography for accurate mapping
-        self.calibration_points_raw = []  # Raw iris positions during calibration
-        self.calibration_points_screen = []  # Corresponding screen positions
+        # Raw iris positions and corresponding screen positions, filled up to _cal_n
+        self._cal_raw = np.empty((CONFIG["CALIBRATION_POINTS"], 2), np.float32)
+        self._cal_scr = np.empty_like(self._cal_raw)
+        self._cal_n = 0
         self.homography_matrix = None
+        self._h = None  # homography_matrix flattened to floats for apply_homography
         self.is_calibrated = False
         
         # Simple offset calibration as fallback
@@ -81,81 +166,183 @@ class ImprovedGazeEstimator:
         # Current raw gaze for calibration
         self.current_raw_gaze = None
         
+        # Pupil detection scratch buffers, keyed by eye ROI size
+        self._pupil_scratch = {}
+        
+        # Screen mapping constants derived from CONFIG
+        self.update_mapping_constants()
+        
+    def pupil_scratch(self, h, w):
+        """Reusable buffers for detect_pupil_center at one eye ROI size"""
+        scratch = self._pupil_scratch.get((h, w))
+        if scratch is None:
+            # Center prior: 1 at the ROI center falling to 0 at the corners
+            yy, xx = np.mgrid[0:h, 0:w]
+            prior = 1 - (((xx - w / 2) / (w / 2)) ** 2 + ((yy - h / 2) / (h / 2)) ** 2) / 2
+            scratch = {
+                "gray": np.empty((h, w), np.uint8),
+                "blurred": np.empty((h, w), np.uint8),
+                "thresh": np.empty((h, w), np.uint8),
+                "dist": np.empty((h, w), np.float32),
+                "prior": prior.astype(np.float32),
+            }
+            self._pupil_scratch[(h, w)] = scratch
+        return scratch
+    
     def detect_pupil_center(self, eye_roi):
         """Improved pupil detection using multiple methods"""
         if eye_roi.size == 0:
             return None
             
-        gray = cv2.cvtColor(eye_roi, cv2.COLOR_BGR2GRAY) if len(eye_roi.shape) == 3 else eye_roi
-        h, w = gray.shape
+        h, w = eye_roi.shape[:2]
+        scratch = self.pupil_scratch(h, w)
+        
+        gray = cv2.cvtColor(eye_roi, cv2.COLOR_BGR2GRAY, dst=scratch["gray"]) if len(eye_roi.shape) == 3 else eye_roi
         
         # Method 1: Find darkest region (pupil is dark)
-        blurred = cv2.GaussianBlur(gray, (7, 7), 0)
+        blurred = cv2.GaussianBlur(gray, (7, 7), 0, dst=scratch["blurred"])
         
-        # Apply histogram equalization for better contrast
-        equalized = cv2.equalizeHist(blurred)
+        # Apply histogram equalization for better contrast; the gray buffer is
+        # free again once blurred exists, so it takes the result. Always
+        # equalized: the fixed threshold below assumes a stretched histogram
+        equalized = cv2.equalizeHist(blurred, dst=scratch["gray"])
         
         # Threshold to find dark pupil
-        _, thresh = cv2.threshold(equalized, 30, 255, cv2.THRESH_BINARY_INV)
-        
-        # Morphological operations to clean up
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-        thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
-        thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
-        
-        # Find contours
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        if contours:
-            # Find the most circular contour
-            best_contour = None
-            best_score = 0
-            
-            for contour in contours:
-                area = cv2.contourArea(contour)
-                if area < 20 or area > (w * h * 0.5):
-                    continue
-                    
-                perimeter = cv2.arcLength(contour, True)
-                if perimeter == 0:
-                    continue
-                    
-                # Circularity score
-                circularity = 4 * np.pi * area / (perimeter * perimeter)
-                
-                if circularity > best_score:
-                    best_score = circularity
-                    best_contour = contour
-            
-            if best_contour is not None:
-                M = cv2.moments(best_contour)
-                if M["m00"] > 0:
-                    cx = int(M["m10"] / M["m00"])
-                    cy = int(M["m01"] / M["m00"])
-                    return (cx, cy)
+        _, thresh = cv2.threshold(equalized, 30, 255, cv2.THRESH_BINARY_INV, dst=scratch["thresh"])
+        
+        # Center of the dark pupil blob = the point deepest inside it. The
+        # distance transform finds it in one pass and shrugs off the small
+        # holes the old open/close + contour search had to clean up. Weighting
+        # by a center prior keeps brows/lashes at the ROI edge from winning.
+        dist = cv2.distanceTransform(thresh, cv2.DIST_L2, 3, dst=scratch["dist"])
+        cv2.multiply(dist, scratch["prior"], dst=dist)
+        _, max_dist, _, center = cv2.minMaxLoc(dist)
+        if max_dist > 0:
+            return center
         
         # Method 2: Find minimum intensity point as fallback
         min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(blurred)
         return min_loc
     
-    def estimate_gaze(self, frame):
-        """Estimate gaze position with improved accuracy"""
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        h, w = frame.shape[:2]
+    def update_mapping_constants(self):
+        """Recompute the screen mapping constants; call whenever screen size or sensitivity changes"""
+        screen_w = CONFIG["SCREEN_WIDTH"]
+        screen_h = CONFIG["SCREEN_HEIGHT"]
+        
+        self._screen_w = screen_w
+        self._screen_h = screen_h
+        self._screen_cx = screen_w / 2
+        self._screen_cy = screen_h / 2
+        # Detection runs on the unflipped camera frame; with MIRROR_CAMERA the
+        # horizontal terms are negated here instead of flipping every frame
+        mirror = -1 if CONFIG.get("MIRROR_CAMERA", True) else 1
+        self._iris_scale_x = mirror * CONFIG["SENSITIVITY_X"] * screen_w / 4
+        self._iris_scale_y = CONFIG["SENSITIVITY_Y"] * screen_h / 4
+        self._head_scale_x = mirror * CONFIG["HEAD_COMPENSATION_X"] * screen_w
+        self._head_scale_y = CONFIG["HEAD_COMPENSATION_Y"] * screen_h
+    
+    def is_static(self, gray_small):
+        """True when the frame barely differs from the last one the cascades ran on"""
+        thumb = cv2.resize(gray_small, (80, 60), interpolation=cv2.INTER_AREA)
+        
+        static = False
+        if (self._prev_thumb is not None and self.last_face is not None
+                and len(self.last_eyes) == 2
+                and self.static_frames < CONFIG["MOTION_SKIP_MAX_FRAMES"]):
+            diff = cv2.norm(thumb, self._prev_thumb, cv2.NORM_L1) / (80 * 60)
+            static = diff < CONFIG["MOTION_SKIP_THRESHOLD"]
+        
+        if static:
+            self.static_frames += 1
+        else:
+            self.static_frames = 0
+            self._prev_thumb = thumb
+        return static
+    
+    def detect_face(self, gray_small, small_w, small_h):
+        """Detect faces in the half-resolution gray frame, searching near the last face between full scans"""
+        self.frames_since_scan += 1
+        
+        if (self.last_face is not None and self.roi_misses < 2
+                and self.frames_since_scan < CONFIG["FACE_RESCAN_INTERVAL"]):
+            fx, fy, fw, fh = (int(v) // 2 for v in self.last_face)
+            margin_x, margin_y = int(fw * 0.2), int(fh * 0.2)
+            x0, y0 = max(0, fx - margin_x), max(0, fy - margin_y)
+            x1, y1 = min(small_w, fx + fw + margin_x), min(small_h, fy + fh + margin_y)
+            
+            roi = cv2.UMat(gray_small, (y0, y1), (x0, x1))
+            faces = self.face_cascade.detectMultiScale(
+                roi, scaleFactor=1.1, minNeighbors=4, minSize=(int(fw * 0.8), int(fh * 0.8))
+            )
+            
+            if len(faces) > 0:
+                self.roi_misses = 0
+                return faces + (x0, y0, 0, 0)
+            
+            self.roi_misses += 1
+            return faces
         
-        # Detect face
+        self.frames_since_scan = 0
         faces = self.face_cascade.detectMultiScale(
-            gray, scaleFactor=1.1, minNeighbors=4, minSize=(80, 80)
+            gray_small, scaleFactor=1.1, minNeighbors=4, minSize=(40, 40)
+        )
+        if len(faces) > 0:
+            self.roi_misses = 0
+        
+        return faces
+    
+    def detect_eyes(self, eye_region, region_w, region_h):
+        """Detect eyes in the upper face region, searching near the last eyes while tracking"""
+        if self.frames_since_scan > 0 and len(self.last_eyes) == 2:
+            margin = int(max(e[2] for e in self.last_eyes) * 0.25)
+            x0 = max(0, int(min(e[0] for e in self.last_eyes)) - margin)
+            y0 = max(0, int(min(e[1] for e in self.last_eyes)) - margin)
+            x1 = min(region_w, int(max(e[0] + e[2] for e in self.last_eyes)) + margin)
+            y1 = min(region_h, int(max(e[1] + e[3] for e in self.last_eyes)) + margin)
+            
+            if x1 > x0 and y1 > y0:
+                roi = cv2.UMat(eye_region, (y0, y1), (x0, x1))
+                eyes = self.eye_cascade.detectMultiScale(
+                    roi, scaleFactor=1.1, minNeighbors=3, minSize=(25, 25)
+                )
+                if len(eyes) > 0:
+                    return eyes + (x0, y0, 0, 0)
+        
+        return self.eye_cascade.detectMultiScale(
+            eye_region, scaleFactor=1.1, minNeighbors=3, minSize=(25, 25)
         )
+    
+    def estimate_gaze(self, frame, gray=None):
+        """Estimate gaze position with improved accuracy; returns the gaze plus face/eye/pupil boxes for overlays"""
+        result = {"gaze": None, "face": None, "eyes": [], "pupils": []}
+        
+        # UMat lets OpenCV dispatch the cascades to OpenCL (falls back to CPU transparently)
+        if gray is None:
+            gray = cv2.cvtColor(cv2.UMat(frame), cv2.COLOR_BGR2GRAY)
+        h, w = frame.shape[:2]
+        
+        # Detect face on a half-resolution copy (cascade cost scales with pixel
+        # count) and scale the boxes back up to full-frame coordinates
+        gray_small = cv2.pyrDown(gray)
+        
+        # Static image: keep the last face/eye boxes and only re-run the pupil locator
+        static = self.is_static(gray_small)
+        if static:
+            faces = [self.last_face]
+        else:
+            faces = self.detect_face(gray_small, (w + 1) // 2, (h + 1) // 2)
+            if len(faces) > 0:
+                faces = faces * 2
         
         if len(faces) == 0:
             if self.last_face is not None:
                 faces = [self.last_face]
             else:
-                return None
+                return result
         
-        (fx, fy, fw, fh) = faces[0]
+        (fx, fy, fw, fh) = (int(v) for v in faces[0])
         self.last_face = faces[0]
+        result["face"] = (fx, fy, fw, fh)
         
         # Calculate head position relative to center
         head_x = (fx + fw/2 - w/2) / (w/2)  # -1 to 1
@@ -169,48 +356,58 @@ class ImprovedGazeEstimator:
         head_delta_y = head_y - self.baseline_head[1]
         
         # Extract upper face for eyes
-        eye_region = gray[fy:fy + int(fh * 0.6), fx:fx + fw]
-        eye_region_color = frame[fy:fy + int(fh * 0.6), fx:fx + fw]
+        eye_h = int(fh * 0.6)
+        if eye_h == 0 or fw == 0:
+            return result
         
-        if eye_region.size == 0:
-            return None
+        eye_region = cv2.UMat(gray, (fy, fy + eye_h), (fx, fx + fw))
+        eye_region_color = frame[fy:fy + eye_h, fx:fx + fw]
         
         # Detect eyes
-        eyes = self.eye_cascade.detectMultiScale(
-            eye_region, scaleFactor=1.1, minNeighbors=3, minSize=(25, 25)
-        )
+        eyes = self.last_eyes if static else self.detect_eyes(eye_region, fw, eye_h)
         
         if len(eyes) < 1:
             if len(self.last_eyes) > 0:
                 eyes = self.last_eyes
             else:
-                return None
-        
-        # Sort and take up to 2 eyes
-        eyes = sorted(eyes, key=lambda e: e[0])[:2]
+                return result
+        
+        # Keep the two leftmost eyes as seen in the preview (the rightmost in the
+        # raw frame with MIRROR_CAMERA), ordered left to right; detectMultiScale
+        # returns an (N, 4) array, so extra hits are dropped with one argpartition
+        if len(eyes) > 2:
+            order = -eyes[:, 0] if CONFIG.get("MIRROR_CAMERA", True) else eyes[:, 0]
+            eyes = eyes[np.argpartition(order, 1)[:2]]
+        if len(eyes) == 2 and eyes[1][0] < eyes[0][0]:
+            eyes = [eyes[1], eyes[0]]
         self.last_eyes = list(eyes)
         
         # Get pupil positions
         iris_positions = []
         
         for (ex, ey, ew, eh) in eyes:
+            result["eyes"].append((fx + ex, fy + ey, ew, eh))
+            
             eye_roi = eye_region_color[ey:ey+eh, ex:ex+ew]
             if eye_roi.size == 0:
                 continue
             
             pupil = self.detect_pupil_center(eye_roi)
             if pupil:
+                result["pupils"].append((fx + ex + pupil[0], fy + ey + pupil[1]))
+                
                 # Normalize pupil position within eye region (-1 to 1)
                 norm_x = (pupil[0] - ew/2) / (ew/2)
                 norm_y = (pupil[1] - eh/2) / (eh/2)
                 iris_positions.append((norm_x, norm_y))
         
         if len(iris_positions) == 0:
-            return None
+            return result
         
-        # Average iris position
-        avg_iris_x = np.mean([p[0] for p in iris_positions])
-        avg_iris_y = np.mean([p[1] for p in iris_positions])
+        # Average iris position (at most two eyes, so plain arithmetic beats np.mean)
+        n = len(iris_positions)
+        avg_iris_x = sum(p[0] for p in iris_positions) / n
+        avg_iris_y = sum(p[1] for p in iris_positions) / n
         
         # Set baseline on first detection
         if self.baseline_iris is None:
@@ -220,19 +417,15 @@ class ImprovedGazeEstimator:
         iris_delta_x = avg_iris_x - self.baseline_iris[0]
         iris_delta_y = avg_iris_y - self.baseline_iris[1]
         
-        # Combine iris tracking with head compensation
-        # Screen center
-        screen_cx = CONFIG["SCREEN_WIDTH"] / 2
-        screen_cy = CONFIG["SCREEN_HEIGHT"] / 2
-        
-        # Map iris movement to screen coordinates
+        # Combine iris tracking with head compensation (constants from update_mapping_constants)
+        # Map iris movement to screen coordinates around the screen center
         # When looking right, iris moves right in mirrored view, which should map to right on screen
-        raw_x = screen_cx + (iris_delta_x * CONFIG["SENSITIVITY_X"] * CONFIG["SCREEN_WIDTH"] / 4)
-        raw_y = screen_cy + (iris_delta_y * CONFIG["SENSITIVITY_Y"] * CONFIG["SCREEN_HEIGHT"] / 4)
+        raw_x = self._screen_cx + iris_delta_x * self._iris_scale_x
+        raw_y = self._screen_cy + iris_delta_y * self._iris_scale_y
         
         # Add head compensation
-        raw_x -= head_delta_x * CONFIG["HEAD_COMPENSATION_X"] * CONFIG["SCREEN_WIDTH"]
-        raw_y += head_delta_y * CONFIG["HEAD_COMPENSATION_Y"] * CONFIG["SCREEN_HEIGHT"]
+        raw_x -= head_delta_x * self._head_scale_x
+        raw_y += head_delta_y * self._head_scale_y
         
         # Store raw gaze for calibration
         self.current_raw_gaze = (raw_x, raw_y)
@@ -240,10 +433,7 @@ class ImprovedGazeEstimator:
         # Apply calibration if available
         if self.is_calibrated and self.homography_matrix is not None:
             # Use homography for accurate mapping
-            point = np.array([[[raw_x, raw_y]]], dtype=np.float32)
-            transformed = cv2.perspectiveTransform(point, self.homography_matrix)
-            calibrated_x = transformed[0][0][0]
-            calibrated_y = transformed[0][0][1]
+            calibrated_x, calibrated_y = self.apply_homography(raw_x, raw_y)
         elif self.is_calibrated:
             # Simple offset/scale calibration
             calibrated_x = (raw_x - self.offset_x) * self.scale_x
@@ -253,29 +443,51 @@ class ImprovedGazeEstimator:
             calibrated_y = raw_y
         
         # Clamp to screen
-        calibrated_x = max(0, min(CONFIG["SCREEN_WIDTH"], calibrated_x))
-        calibrated_y = max(0, min(CONFIG["SCREEN_HEIGHT"], calibrated_y))
+        calibrated_x = max(0, min(self._screen_w, calibrated_x))
+        calibrated_y = max(0, min(self._screen_h, calibrated_y))
         
         # Apply smoothing
         smoothed_x, smoothed_y = self.smooth_gaze(calibrated_x, calibrated_y)
         
         confidence = min(1.0, 0.5 + len(iris_positions) * 0.25)
         
-        return (smoothed_x, smoothed_y, confidence)
+        result["gaze"] = (smoothed_x, smoothed_y, confidence)
+        return result
+    
+    def apply_homography(self, x, y):
+        """Map one point through the calibration homography"""
+        h00, h01, h02, h10, h11, h12, h20, h21, h22 = self._h
+        w = h20 * x + h21 * y + h22
+        return (h00 * x + h01 * y + h02) / w, (h10 * x + h11 * y + h12) / w
     
     def smooth_gaze(self, x, y):
         """Smooth gaze with weighted average + EMA"""
-        self.gaze_history_x.append(x)
-        self.gaze_history_y.append(y)
-        
-        # Weighted average (recent = higher weight)
-        if len(self.gaze_history_x) > 0:
-            weights = np.arange(1, len(self.gaze_history_x) + 1, dtype=float)
-            weights = weights / weights.sum()
-            avg_x = np.average(list(self.gaze_history_x), weights=weights)
-            avg_y = np.average(list(self.gaze_history_y), weights=weights)
+        buf = len(self._ring_x)
+        i = self._ring_i
+        n = self._ring_n
+        
+        # Weighted average (recent = higher weight). Once the buffer is full every
+        # older sample loses one unit of weight (wsum - sum) and the oldest drops out
+        if n == buf:
+            self._wsum_x += n * x - self._sum_x
+            self._wsum_y += n * y - self._sum_y
+            self._sum_x += x - self._ring_x[i]
+            self._sum_y += y - self._ring_y[i]
         else:
-            avg_x, avg_y = x, y
+            n += 1
+            self._ring_n = n
+            self._wsum_x += n * x
+            self._wsum_y += n * y
+            self._sum_x += x
+            self._sum_y += y
+        
+        self._ring_x[i] = x
+        self._ring_y[i] = y
+        self._ring_i = (i + 1) % buf
+        
+        total = n * (n + 1) / 2
+        avg_x = self._wsum_x / total
+        avg_y = self._wsum_y / total
         
         # EMA
         if self.ema_x is None:
@@ -296,30 +508,64 @@ class ImprovedGazeEstimator:
         
         raw_x, raw_y = self.current_raw_gaze
         
-        self.calibration_points_raw.append([raw_x, raw_y])
-        self.calibration_points_screen.append([screen_x, screen_y])
+        # Extra clicks past CALIBRATION_POINTS keep refining, so grow when full
+        n = self._cal_n
+        if n == len(self._cal_raw):
+            self._cal_raw = np.concatenate([self._cal_raw, np.empty_like(self._cal_raw)])
+            self._cal_scr = np.concatenate([self._cal_scr, np.empty_like(self._cal_scr)])
         
-        print(f"Calibration point {len(self.calibration_points_screen)}: screen=({screen_x}, {screen_y}), raw=({raw_x:.0f}, {raw_y:.0f})")
+        self._cal_raw[n] = (raw_x, raw_y)
+        self._cal_scr[n] = (screen_x, screen_y)
+        self._cal_n = n + 1
         
-        if len(self.calibration_points_screen) >= CONFIG["CALIBRATION_POINTS"]:
+        print(f"Calibration point {self._cal_n}: screen=({screen_x}, {screen_y}), raw=({raw_x:.0f}, {raw_y:.0f})")
+        
+        if self._cal_n >= CONFIG["CALIBRATION_POINTS"]:
             self.compute_calibration()
         
         return True
     
+    @property
+    def calibration_point_count(self):
+        """Number of calibration points collected so far"""
+        return self._cal_n
+    
+    @staticmethod
+    def fit_homography(src, dst):
+        """Least-squares homography mapping src points onto dst, or None if degenerate"""
+        x, y = src[:, 0].astype(np.float64), src[:, 1].astype(np.float64)
+        u, v = dst[:, 0].astype(np.float64), dst[:, 1].astype(np.float64)
+        n = len(src)
+        
+        # Two rows per point: [x y 1 0 0 0 -xu -yu] . h = u and [0 0 0 x y 1 -xv -yv] . h = v
+        A = np.zeros((2 * n, 8))
+        A[0::2, 0], A[0::2, 1], A[0::2, 2] = x, y, 1
+        A[1::2, 3], A[1::2, 4], A[1::2, 5] = x, y, 1
+        A[0::2, 6], A[0::2, 7] = -x * u, -y * u
+        A[1::2, 6], A[1::2, 7] = -x * v, -y * v
+        b = np.empty(2 * n)
+        b[0::2], b[1::2] = u, v
+        
+        h, _, rank, _ = np.linalg.lstsq(A, b, rcond=None)
+        if rank < 8:
+            return None
+        return np.append(h, 1.0).reshape(3, 3)
+    
     def compute_calibration(self):
         """Compute calibration transformation"""
-        if len(self.calibration_points_screen) < 4:
+        if self._cal_n < 4:
             print("Need at least 4 points for calibration")
             return
         
-        raw_pts = np.array(self.calibration_points_raw, dtype=np.float32)
-        screen_pts = np.array(self.calibration_points_screen, dtype=np.float32)
+        raw_pts = self._cal_raw[:self._cal_n]
+        screen_pts = self._cal_scr[:self._cal_n]
         
         try:
             # Try homography for accurate mapping
-            self.homography_matrix, _ = cv2.findHomography(raw_pts, screen_pts, cv2.RANSAC, 5.0)
+            self.homography_matrix = self.fit_homography(raw_pts, screen_pts)
             
             if self.homography_matrix is not None:
+                self._h = tuple(float(v) for v in self.homography_matrix.ravel())
                 self.is_calibrated = True
                 print("✅ Calibration complete using homography!")
                 return
@@ -348,9 +594,9 @@ class ImprovedGazeEstimator:
     
     def reset_calibration(self):
         """Reset all calibration data"""
-        self.calibration_points_raw = []
-        self.calibration_points_screen = []
+        self._cal_n = 0
         self.homography_matrix = None
+        self._h = None
         self.is_calibrated = False
         self.offset_x = 0
         self.offset_y = 0
@@ -366,10 +612,39 @@ class GazeServer:
         self.gaze_estimator = ImprovedGazeEstimator()
         self.cap = None
         self.clients = set()
+        self.preview_clients = set()
         self.running = False
+        self.tracking_task = None
+        self.tracking_client = None  # websocket the tracking task streams to
+        
+        # Worker threads for the tracking pipeline: a dedicated capture thread
+        # (started per tracking session), a CV thread, and one for preview JPEG
+        # encoding so it never delays gaze packets
+        self.capture_thread = None
+        # OpenCV's OpenCL switch is per thread, so the CV thread sets its own
+        self.cv_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, initializer=cv2.ocl.setUseOpenCL, initargs=(CONFIG["USE_OPENCL"],))
+        self.encode_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        
+        # Reusable frame buffers: _gray is only touched by the CV thread,
+        # _small (the preview) only by the encoder thread
+        self._gray = None
+        self._gray_shape = None
+        self._small = np.empty((240, 320, 3), np.uint8)
+        self._small_raw = np.empty((240, 320, 3), np.uint8)
         
     def start_camera(self):
+        # SIMD kernels on, and half the cores for OpenCV's parallel_for_ so the
+        # capture/encoder threads and the event loop still get CPU time
+        cv2.setUseOptimized(True)
+        cv2.setNumThreads(max(1, (os.cpu_count() or 2) // 2))
+        
         self.cap = cv2.VideoCapture(CONFIG["CAMERA_ID"])
+        # MJPG is cheaper over USB than raw YUYV, and a one-frame driver buffer
+        # means each read returns the newest frame instead of a queued one
+        # (both are ignored by backends that don't support them)
+        self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, CONFIG["CAMERA_WIDTH"])
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CONFIG["CAMERA_HEIGHT"])
         self.cap.set(cv2.CAP_PROP_FPS, CONFIG["CAMERA_FPS"])
@@ -378,8 +653,18 @@ class GazeServer:
             raise RuntimeError("Could not open camera")
         
         print(f"Camera started: {CONFIG['CAMERA_WIDTH']}x{CONFIG['CAMERA_HEIGHT']} @ {CONFIG['CAMERA_FPS']}fps")
+        use_opencl = self.cv_pool.submit(cv2.ocl.useOpenCL).result()
+        print(f"OpenCL: {'enabled' if use_opencl else 'off'}, "
+              f"OpenCV threads: {cv2.getNumThreads()}")
     
     def stop_camera(self):
+        # Let any in-flight read/detection finish before releasing the camera
+        self.running = False
+        if self.capture_thread is not None:
+            self.capture_thread.join()
+        self.cv_pool.shutdown(wait=True)
+        self.encode_pool.shutdown(wait=True)
+        
         if self.cap:
             self.cap.release()
             self.cap = None
@@ -390,42 +675,76 @@ class GazeServer:
         
         try:
             async for message in websocket:
-                data = json.loads(message)
+                data = orjson.loads(message)
                 await self.handle_message(websocket, data)
         except websockets.exceptions.ConnectionClosed:
             pass
         finally:
             self.clients.remove(websocket)
+            # Don't leave a pipeline streaming to a closed socket
+            if self.tracking_client is websocket:
+                await self.cancel_tracking()
             print(f"Client disconnected")
     
+    async def handle_preview(self, websocket):
+        """Preview socket: receives binary JPEG frames only"""
+        print(f"Preview client connected")
+        self.preview_clients.add(websocket)
+        
+        try:
+            await websocket.wait_closed()
+        finally:
+            self.preview_clients.discard(websocket)
+            print(f"Preview client disconnected")
+    
+    async def cancel_tracking(self):
+        """Stop the tracking pipeline, if any, and wait until it has shut down"""
+        self.running = False
+        task = self.tracking_task
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        self.tracking_task = None
+        self.tracking_client = None
+    
+    async def run_on_cv_thread(self, func, *args):
+        """Run func on the CV thread, so estimator state is never changed mid-frame"""
+        return await asyncio.get_running_loop().run_in_executor(self.cv_pool, func, *args)
+    
     async def handle_message(self, websocket, data):
         msg_type = data.get("type")
         
         if msg_type == "screen_size":
             CONFIG["SCREEN_WIDTH"] = data.get("width", 1920)
             CONFIG["SCREEN_HEIGHT"] = data.get("height", 1080)
+            await self.run_on_cv_thread(self.gaze_estimator.update_mapping_constants)
             print(f"Screen size: {CONFIG['SCREEN_WIDTH']}x{CONFIG['SCREEN_HEIGHT']}")
             
         elif msg_type == "calibration_point":
             screen_x = data.get("screen_x")
             screen_y = data.get("screen_y")
             
-            success = self.gaze_estimator.add_calibration_point(screen_x, screen_y)
+            success = await self.run_on_cv_thread(self.gaze_estimator.add_calibration_point, screen_x, screen_y)
             
-            await websocket.send(json.dumps({
+            await websocket.send(dumps({
                 "type": "calibration_ack",
-                "points_collected": len(self.gaze_estimator.calibration_points_screen),
+                "points_collected": self.gaze_estimator.calibration_point_count,
                 "is_calibrated": self.gaze_estimator.is_calibrated,
                 "success": success
             }))
                     
         elif msg_type == "reset_calibration":
-            self.gaze_estimator.reset_calibration()
-            await websocket.send(json.dumps({"type": "calibration_reset"}))
+            await self.run_on_cv_thread(self.gaze_estimator.reset_calibration)
+            await websocket.send(dumps({"type": "calibration_reset"}))
             
         elif msg_type == "start_tracking":
+            # Run the pipeline as its own task so this client's messages
+            # (calibration points, stop_tracking) keep being handled meanwhile
+            # Any earlier session is shut down first, so the newest request always wins
+            await self.cancel_tracking()
             self.running = True
-            await self.tracking_loop(websocket)
+            self.tracking_client = websocket
+            self.tracking_task = asyncio.create_task(self.tracking_loop(websocket))
             
         elif msg_type == "stop_tracking":
             self.running = False
@@ -433,101 +752,224 @@ class GazeServer:
         elif msg_type == "adjust_sensitivity":
             CONFIG["SENSITIVITY_X"] = data.get("x", CONFIG["SENSITIVITY_X"])
             CONFIG["SENSITIVITY_Y"] = data.get("y", CONFIG["SENSITIVITY_Y"])
+            await self.run_on_cv_thread(self.gaze_estimator.update_mapping_constants)
             print(f"Sensitivity adjusted: X={CONFIG['SENSITIVITY_X']}, Y={CONFIG['SENSITIVITY_Y']}")
     
-    async def tracking_loop(self, websocket):
+    def read_frame(self):
+        """Read one frame from the camera (runs on the capture thread)"""
+        ret, frame = self.cap.read()
+        if not ret:
+            return None
+        
+        # No flip here: detection works on the raw frame and only the
+        # preview is mirrored (see update_mapping_constants / encode_preview)
+        return frame
+    
+    def process_frame(self, frame):
+        """Convert to grayscale into the reusable buffer and estimate gaze (runs on the CV thread)"""
+        shape = frame.shape[:2]
+        if self._gray_shape != shape:
+            self._gray = cv2.UMat(shape[0], shape[1], cv2.CV_8UC1)
+            self._gray_shape = shape
+        
+        cv2.cvtColor(cv2.UMat(frame), cv2.COLOR_BGR2GRAY, dst=self._gray)
+        return self.gaze_estimator.estimate_gaze(frame, gray=self._gray)
+    
+    def capture_loop(self, loop, frames):
+        """Stage 1 (capture thread): read frames back to back and hand the newest to the event loop"""
         frame_time = 1.0 / CONFIG["CAMERA_FPS"]
-        frame_count = 0
+        # Fixed deadlines on the monotonic clock, so sleep overshoot doesn't accumulate
+        next_deadline = time.monotonic() + frame_time
         
-        print("Starting tracking loop...")
+        try:
+            while self.running:
+                frame = self.read_frame()
+                if frame is not None:
+                    loop.call_soon_threadsafe(frames.put, (time.perf_counter(), frame))
+                
+                # Skip sub-millisecond sleeps (they cost more than they wait), and if
+                # more than two frames behind, resync instead of bursting to catch up
+                now = time.monotonic()
+                delay = next_deadline - now
+                if delay > 0.001:
+                    time.sleep(delay)
+                elif delay < -2 * frame_time:
+                    next_deadline = now
+                next_deadline += frame_time
+        finally:
+            try:
+                loop.call_soon_threadsafe(frames.put, None)
+            except RuntimeError:
+                pass  # event loop already closed during shutdown
+    
+    async def cv_stage(self, frames, results):
+        """Stage 2: run face/eye/pupil detection on the CV thread"""
+        loop = asyncio.get_running_loop()
         
-        while self.running:
-            start_time = time.time()
-            
-            ret, frame = self.cap.read()
-            if not ret:
+        try:
+            while True:
+                item = await frames.get()
+                if item is None:
+                    break
+                
+                captured_at, frame = item
+                cv_start = time.perf_counter()
+                try:
+                    result = await loop.run_in_executor(self.cv_pool, self.process_frame, frame)
+                except Exception as e:
+                    # Drop the frame; one bad frame must not stop tracking
+                    print(f"Detection error: {e}")
+                    continue
+                cv_ms = (time.perf_counter() - cv_start) * 1000
+                
+                results.put((captured_at, cv_ms, frame, result))
+        finally:
+            # Always end send_stage, or it would wait on results forever
+            results.put(None)
+    
+    def encode_preview(self, frame, status, status_color):
+        """Downscale, mirror and JPEG-encode a preview frame into a binary message (runs on the encoder thread)"""
+        # Mirror the small preview rather than the full camera frame
+        if CONFIG.get("MIRROR_CAMERA", True):
+            cv2.resize(frame, (320, 240), dst=self._small_raw)
+            small = cv2.flip(self._small_raw, 1, dst=self._small)
+        else:
+            small = cv2.resize(frame, (320, 240), dst=self._small)
+        
+        # Status text goes on after the flip so it stays readable
+        cv2.putText(small, status, (5, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.35, status_color, 1)
+        _, buffer = cv2.imencode('.jpg', small, [cv2.IMWRITE_JPEG_QUALITY, 60])
+        return MSG_PREVIEW_JPEG + buffer.tobytes()
+    
+    async def preview_stage(self, previews):
+        """Encode and send preview frames to the preview socket clients; only the newest queued frame is kept"""
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            frame, status, status_color = await previews.get()
+            try:
+                message = await loop.run_in_executor(
+                    self.encode_pool, self.encode_preview, frame, status, status_color)
+            except Exception as e:
+                print(f"Preview error: {e}")
                 continue
             
-            # Mirror the camera frame horizontally (like looking in a mirror)
-            if CONFIG.get("MIRROR_CAMERA", True):
-                frame = cv2.flip(frame, 1)
+            # One frame for every viewer, written without a per-client await;
+            # closed connections are skipped and handle_preview removes them
+            websockets.broadcast(self.preview_clients, message)
+    
+    async def send_stage(self, websocket, results, previews):
+        """Stage 3: draw the preview overlay and stream results to the browser"""
+        frame_count = 0
+        last_captured_at = None
+        gaze_batch = []
+        last_batch_sent = time.monotonic()
+        
+        while True:
+            item = await results.get()
+            if item is None:
+                break
             
+            captured_at, cv_ms, frame, result = item
             frame_count += 1
             
-            # Create display frame
-            display_frame = frame.copy()
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            h, w = frame.shape[:2]
-            
-            # Detect and draw faces/eyes for preview
-            faces = self.gaze_estimator.face_cascade.detectMultiScale(
-                gray, scaleFactor=1.1, minNeighbors=4, minSize=(80, 80)
-            )
-            
-            result = self.gaze_estimator.estimate_gaze(frame)
+            # Every 3rd frame goes to the preview socket (if anyone is connected); the
+            # overlay is drawn just on those, or on every frame if the local window is open
+            send_preview = bool(self.preview_clients) and frame_count % 3 == 0
+            draw_preview = send_preview or CONFIG["SHOW_PREVIEW"]
             
-            # Draw detection on preview
-            if len(faces) > 0:
-                (fx, fy, fw, fh) = faces[0]
-                cv2.rectangle(display_frame, (fx, fy), (fx+fw, fy+fh), (0, 255, 0), 2)
+            # Draw the boxes estimate_gaze already found straight onto the frame (detection is done with it)
+            if draw_preview and result["face"] is not None:
+                (fx, fy, fw, fh) = result["face"]
+                cv2.rectangle(frame, (fx, fy), (fx+fw, fy+fh), (0, 255, 0), 2)
                 
                 # Draw eyes
-                eye_region = gray[fy:fy + int(fh * 0.6), fx:fx + fw]
-                eyes = self.gaze_estimator.eye_cascade.detectMultiScale(
-                    eye_region, scaleFactor=1.1, minNeighbors=3, minSize=(25, 25)
-                )
-                for (ex, ey, ew, eh) in eyes[:2]:
-                    cv2.rectangle(display_frame, (fx+ex, fy+ey), (fx+ex+ew, fy+ey+eh), (255, 0, 0), 2)
-                    # Draw pupil center
-                    cv2.circle(display_frame, (fx+ex+ew//2, fy+ey+eh//2), 3, (0, 255, 255), -1)
+                for (ex, ey, ew, eh) in result["eyes"]:
+                    cv2.rectangle(frame, (ex, ey), (ex+ew, ey+eh), (255, 0, 0), 2)
+                
+                # Draw pupil centers
+                for (px, py) in result["pupils"]:
+                    cv2.circle(frame, (px, py), 3, (0, 255, 255), -1)
             
-            if result:
-                gaze_x, gaze_y, confidence = result
+            if result["gaze"]:
+                gaze_x, gaze_y, confidence = result["gaze"]
                 
                 status = f"Gaze: ({gaze_x:.0f}, {gaze_y:.0f})"
-                cv2.putText(display_frame, status, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+                status_color = (0, 255, 0)
                 
                 if frame_count % 30 == 0:
                     print(f"Gaze: ({gaze_x:.0f}, {gaze_y:.0f}) conf={confidence:.2f}")
                 
+                gaze_batch.append((gaze_x, gaze_y, confidence, time.time_ns() // 1_000_000))
+            else:
+                status = "NO DETECTION"
+                status_color = (0, 0, 255)
+            
+            # Flush the gaze batch once it is full or GAZE_BATCH_INTERVAL_MS has passed since the last send
+            now = time.monotonic()
+            if gaze_batch and (len(gaze_batch) >= CONFIG["GAZE_BATCH_SIZE"] or
+                               (now - last_batch_sent) * 1000 >= CONFIG["GAZE_BATCH_INTERVAL_MS"]):
                 try:
-                    await websocket.send(json.dumps({
-                        "type": "gaze",
-                        "x": round(gaze_x, 1),
-                        "y": round(gaze_y, 1),
-                        "confidence": round(confidence, 2),
-                        "timestamp": time.time() * 1000
-                    }))
+                    await websocket.send(encode_gaze_batch(gaze_batch))
                 except websockets.exceptions.ConnectionClosed:
                     break
-            else:
-                cv2.putText(display_frame, "NO DETECTION", (10, 30), 
-                           cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
+                gaze_batch = []
+                last_batch_sent = now
             
-            # Send frame to browser (every 3rd frame)
-            if frame_count % 3 == 0:
-                try:
-                    small = cv2.resize(display_frame, (320, 240))
-                    _, buffer = cv2.imencode('.jpg', small, [cv2.IMWRITE_JPEG_QUALITY, 60])
-                    frame_b64 = base64.b64encode(buffer).decode('utf-8')
-                    await websocket.send(json.dumps({
-                        "type": "frame",
-                        "data": frame_b64
-                    }))
-                except:
-                    pass
+            # Queue the frame for the preview socket; dropped if the encoder is behind
+            if send_preview:
+                previews.put((frame, status, status_color))
             
             # Optional: Show preview window
             if CONFIG["SHOW_PREVIEW"]:
-                cv2.imshow("Sharingan", display_frame)
-                if cv2.waitKey(1) & 0xFF == ord('q'):
+                display = cv2.flip(frame, 1) if CONFIG.get("MIRROR_CAMERA", True) else frame.copy()
+                cv2.putText(display, status, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, status_color, 2)
+                cv2.imshow("Sharingan", display)
+                # pollKey returns immediately, so the event loop never sleeps in HighGUI
+                if cv2.pollKey() & 0xFF == ord('q'):
                     break
             
-            elapsed = time.time() - start_time
-            await asyncio.sleep(max(0, frame_time - elapsed))
+            # Pipeline latency: e2e = capture -> sent, cv = detection, f2f = capture interval
+            if frame_count % 30 == 0 and last_captured_at is not None:
+                e2e_ms = (time.perf_counter() - captured_at) * 1000
+                f2f_ms = (captured_at - last_captured_at) * 1000
+                print(f"Latency: e2e={e2e_ms:.1f}ms cv={cv_ms:.1f}ms f2f={f2f_ms:.1f}ms")
+            last_captured_at = captured_at
+    
+    async def tracking_loop(self, websocket):
+        # Bounded queues between stages; put() drops the oldest item so
+        # latency stays bounded when detection can't keep up with the camera
+        frames = LatestQueue(maxsize=2)
+        results = LatestQueue(maxsize=2)
+        previews = LatestQueue(maxsize=1)
+        
+        print("Starting tracking loop...")
+        
+        loop = asyncio.get_running_loop()
+        capture_thread = threading.Thread(
+            target=self.capture_loop, args=(loop, frames), name="capture", daemon=True)
+        self.capture_thread = capture_thread
+        capture_thread.start()
         
-        if CONFIG["SHOW_PREVIEW"]:
-            cv2.destroyAllWindows()
+        stages = [
+            asyncio.create_task(self.cv_stage(frames, results)),
+            asyncio.create_task(self.preview_stage(previews)),
+        ]
+        
+        try:
+            await self.send_stage(websocket, results, previews)
+        except Exception as e:
+            print(f"Tracking error: {e}")
+        finally:
+            self.running = False
+            for stage in stages:
+                stage.cancel()
+            
+            # Wait for the in-flight read so the next session can't overlap it
+            await loop.run_in_executor(None, capture_thread.join)
+            
+            if CONFIG["SHOW_PREVIEW"]:
+                cv2.destroyAllWindows()
     
     async def run(self):
         self.start_camera()
@@ -535,10 +977,17 @@ class GazeServer:
         print(f"\n{'='*50}")
         print(f"  SHARINGAN GAZE SERVER - IMPROVED ACCURACY")
         print(f"  WebSocket: ws://localhost:{CONFIG['WEBSOCKET_PORT']}")
+        print(f"  Preview:   ws://localhost:{CONFIG['PREVIEW_PORT']}")
         print(f"  Sensitivity: X={CONFIG['SENSITIVITY_X']}, Y={CONFIG['SENSITIVITY_Y']}")
         print(f"{'='*50}\n")
         
-        async with websockets.serve(self.handle_client, "localhost", CONFIG["WEBSOCKET_PORT"]):
+        # No permessage-deflate: gaze messages are a few hundred bytes and the
+        # preview is already JPEG, so zlib would only burn CPU. Client messages
+        # are small control JSON, hence the 64 KiB inbound limit.
+        serve_options = {"compression": None, "max_size": 2 ** 16}
+        
+        async with websockets.serve(self.handle_client, "localhost", CONFIG["WEBSOCKET_PORT"], **serve_options), \
+                   websockets.serve(self.handle_preview, "localhost", CONFIG["PREVIEW_PORT"], **serve_options):
             await asyncio.Future()
 
 
@@ -548,6 +997,9 @@ def main():
     
     server = GazeServer()
     
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    
     try:
         asyncio.run(server.run())
     except KeyboardInterrupt: